@@ -3,11 +3,20 @@ import pandas as pd
 from datetime import datetime
 import psycopg2
 from psycopg2 import OperationalError
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 import hashlib
+import json
 import base64 
 from dotenv import load_dotenv
 import os
+import re
+import string
+import threading
+import time
+from contextlib import ExitStack, contextmanager
 
 
 load_dotenv()
@@ -21,170 +30,591 @@ DB_CONFIG = {
     'dbname': os.getenv('DB_NAME'),  
 }
 
+# Conexões abertas (e preparadas em warm_up_pool) já na subida do app
+POOL_MIN_CONN = 2
+
+# Intervalo mínimo entre novas tentativas de migrações obrigatórias que falharam (ensure_db_objects)
+MIGRATION_RETRY_SECONDS = 300
+
+# Linhas por lote ao ler tabelas inteiras com cursor server-side (fetch_all)
+FETCH_BATCH_SIZE = 5000
+# Máximo de linhas trazidas para as tabelas de visualização (estoque, histórico de entradas)
+DISPLAY_ROW_LIMIT = 500
+
+# INSERTs mais frequentes, preparados (PREPARE) uma vez por conexão do pool e chamados via EXECUTE
+PREPARED_STATEMENTS = {
+    'ins_cliente': """
+        INSERT INTO Clientes (nome, cpf_cnpj, telefone, email, endereco, created_at)
+        VALUES ($1, $2, $3, $4, $5, $6)
+    """,
+    'ins_fornecedor': """
+        INSERT INTO Fornecedores (nome_fantasia, cnpj, telefone, email, contato)
+        VALUES ($1, $2, $3, $4, $5)
+    """,
+    'ins_categoria': "INSERT INTO Categorias (nome_categoria) VALUES ($1)",
+    'ins_produto': """
+        INSERT INTO Produtos (codigo_sku, descricao, marca, preco_custo, preco_venda, estoque_atual, estoque_minimo, categoria_id, fornecedor_id, modelo_moto, ano_moto)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+    """,
+    # Devolução: registra o item e, se apto, devolve a quantidade ao estoque num só comando
+    'registrar_devolucao': """
+        WITH d AS (
+            INSERT INTO Devolucoes (pedido_id, produto_id, quantidade, estado_produto, retornou_estoque, motivo, data_devolucao)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            RETURNING produto_id, quantidade, retornou_estoque
+        )
+        UPDATE Produtos P
+        SET estoque_atual = P.estoque_atual + d.quantidade
+        FROM d
+        WHERE d.retornou_estoque AND P.produto_id = d.produto_id
+    """,
+    # Troca de status de vários pedidos: lista como array, um plano só para qualquer quantidade
+    'upd_status_pedidos': "UPDATE Pedidos SET status_pedido = $1 WHERE pedido_id = ANY($2::int[])",
+    # Entrada de compra: registra no histórico e atualiza estoque + custo médio ponderado num só comando
+    'receber_entrada': """
+        WITH ins AS (
+            INSERT INTO Entradas (produto_id, fornecedor_id, data_recebimento, emissao, quantidade_comprada, valor_unitario_compra, numero_nota_fiscal)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            RETURNING produto_id, quantidade_comprada, valor_unitario_compra
+        )
+        UPDATE Produtos P
+        SET estoque_atual = COALESCE(P.estoque_atual, 0) + ins.quantidade_comprada,
+            preco_custo = CASE
+                WHEN COALESCE(P.estoque_atual, 0) + ins.quantidade_comprada > 0 THEN ROUND((
+                    (COALESCE(P.estoque_atual, 0) * COALESCE(P.preco_custo, 0) + ins.quantidade_comprada * ins.valor_unitario_compra)
+                    / (COALESCE(P.estoque_atual, 0) + ins.quantidade_comprada)
+                )::numeric, 4)
+                ELSE ins.valor_unitario_compra
+            END
+        FROM ins
+        WHERE P.produto_id = ins.produto_id
+        RETURNING P.estoque_atual
+    """,
+}
+
+# Comandos preparados que alteram dados (INSERT/UPDATE/DELETE no corpo, inclusive dentro de CTEs)
+PREPARED_WRITES = frozenset(
+    name for name, sql in PREPARED_STATEMENTS.items()
+    if re.search(r"\b(INSERT|UPDATE|DELETE)\b", sql, re.IGNORECASE)
+)
+
+# Migrações do banco aplicadas por ensure_db_objects() e registradas em app_migrations:
+# (nome, comando(s) SQL, obrigatória). Cada uma roda sozinha, em autocommit, uma única vez por banco;
+# nomes já aplicados não voltam a ser executados. Novas migrações entram sempre no fim da lista.
+DB_MIGRATIONS = [
+    # Estoque atual de produtos com categoria e fornecedor (tela "Produtos (Estoque)")
+    ("001_v_produtos_display", """
+            CREATE OR REPLACE VIEW v_produtos_display AS
+            SELECT P.codigo_sku, P.marca, P.descricao, P.ano_moto,
+                   P.preco_custo, P.preco_venda, P.estoque_atual, P.estoque_minimo,
+                   C.nome_categoria, F.nome_fantasia AS fornecedor, P.ativo AS status
+            FROM Produtos P
+            LEFT JOIN Categorias C ON P.categoria_id = C.categoria_id
+            LEFT JOIN Fornecedores F ON P.fornecedor_id = F.fornecedor_id
+        """, True),
+    # Histórico de entradas de estoque com produto e fornecedor (tela "Compras")
+    ("002_v_entradas_historico", """
+            CREATE OR REPLACE VIEW v_entradas_historico AS
+            SELECT F.nome_fantasia AS fornecedor, P.descricao AS produto,
+                   E.emissao, E.data_recebimento,
+                   E.quantidade_comprada, E.valor_unitario_compra, E.numero_nota_fiscal
+            FROM Entradas E
+            LEFT JOIN Produtos P ON E.produto_id = P.produto_id
+            LEFT JOIN Fornecedores F ON E.fornecedor_id = F.fornecedor_id
+        """, True),
+    # Itens por pedido (cupom, devoluções) servidos só pelo índice (index-only scan).
+    # Índices em CONCURRENTLY para não bloquear escritas; o DROP descarta um índice inválido
+    # deixado por uma tentativa anterior interrompida
+    ("003_idx_vendas_pedido", (
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_vendas_pedido",
+        """
+            CREATE INDEX CONCURRENTLY idx_vendas_pedido
+            ON Vendas (pedido_id) INCLUDE (produto_id, quantidade, preco_unitario, subtotal)
+        """,
+    ), True),
+    # Histórico de entradas: ORDER BY data_recebimento DESC LIMIT n lê só o início do índice
+    ("004_idx_entradas_recebimento", (
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_entradas_recebimento",
+        "CREATE INDEX CONCURRENTLY idx_entradas_recebimento ON Entradas (data_recebimento DESC)",
+    ), True),
+    # Listas de pedidos pendentes/concluídos (filtro por status, ordenadas por data)
+    ("005_idx_pedidos_status_data", (
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_pedidos_status_data",
+        "CREATE INDEX CONCURRENTLY idx_pedidos_status_data ON Pedidos (status_pedido, data_pedido)",
+    ), True),
+    # Registro de pedido inteiro (Pedidos + itens em Vendas + baixa de estoque) numa única chamada:
+    # p_itens = [{"produto_id", "quantidade", "preco_unit", "subtotal", "desconto_perc"}, ...];
+    # p_valor_total é o total exibido no carrinho, gravado como está no cabeçalho do pedido.
+    # Obrigatória: o botão "Registrar Pedido" depende dela
+    ("006_create_pedido", (
+        "DROP FUNCTION IF EXISTS create_pedido(int, text, jsonb, timestamp)",
+        """
+            CREATE OR REPLACE FUNCTION create_pedido(p_cliente_id int, p_forma text, p_itens jsonb, p_data timestamp, p_valor_total numeric)
+            RETURNS int
+            LANGUAGE plpgsql AS $$
+            DECLARE
+                v_pedido_id int;
+            BEGIN
+                INSERT INTO Pedidos (cliente_id, data_pedido, valor_total, status_pedido, forma_pagamento)
+                VALUES (p_cliente_id, p_data, p_valor_total, 'Pendente', p_forma)
+                RETURNING pedido_id INTO v_pedido_id;
+
+                INSERT INTO Vendas (pedido_id, produto_id, quantidade, preco_unitario, subtotal, desconto)
+                SELECT v_pedido_id, i.produto_id, i.quantidade, i.preco_unit, i.subtotal, i.desconto_perc
+                FROM jsonb_to_recordset(p_itens) AS i(produto_id int, quantidade int, preco_unit numeric, subtotal numeric, desconto_perc numeric);
+
+                UPDATE Produtos P
+                SET estoque_atual = P.estoque_atual - V.qtd
+                FROM (
+                    SELECT i.produto_id, SUM(i.quantidade) AS qtd
+                    FROM jsonb_to_recordset(p_itens) AS i(produto_id int, quantidade int)
+                    GROUP BY i.produto_id
+                ) V
+                WHERE P.produto_id = V.produto_id;
+
+                RETURN v_pedido_id;
+            END
+            $$
+        """,
+    ), True),
+    # Consulta rápida de estoque (descricao ILIKE '%termo%') via trigramas; opcionais se o pg_trgm não estiver disponível
+    ("007_pg_trgm", "CREATE EXTENSION IF NOT EXISTS pg_trgm", False),
+    ("008_idx_produtos_descricao_trgm", (
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_produtos_descricao_trgm",
+        "CREATE INDEX CONCURRENTLY idx_produtos_descricao_trgm ON Produtos USING gin (descricao gin_trgm_ops)",
+    ), False),
+]
+
 #----------------------------------------------------------------------------------------------------------------
 
 # --- 2. FUNÇÕES DE CONEXÃO E UTILITÁRIOS DB ---
+class PooledConnection(psycopg2.extensions.connection):
+    """Conexão do pool que lembra se o PREPARE de PREPARED_STATEMENTS já foi tentado nela."""
+    statements_prepared = False
+
 @st.cache_resource
-def get_db_connection_cached():
-    """Retorna uma conexão CACHEADA para LEITURAS (fetch)."""
+def get_db_pool():
+    """Retorna o POOL de conexões compartilhado por todas as sessões (criado uma única vez)."""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
+        return psycopg2.pool.ThreadedConnectionPool(
+            minconn=POOL_MIN_CONN, maxconn=20, connection_factory=PooledConnection, **DB_CONFIG
+        )
     except OperationalError as e:
-        st.error(f"Erro ao conectar ao Supabase (CACHE): {e}")
+        st.error(f"Erro ao conectar ao Supabase (POOL): {e}")
         st.stop()
         return None
 
-def get_db_connection_new():
-    """Retorna uma conexão NOVA para TRANSAÇÕES (compras, pedidos)."""
+@contextmanager
+def get_conn():
+    """Empresta uma conexão do pool e a devolve ao final, descartando transações pendentes."""
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        if not conn.statements_prepared:
+            prepare_statements(conn)
+        yield conn
+    finally:
+        # Rollback é no-op após commit; desfaz o que ficou aberto por erro ou st.stop()
+        try:
+            conn.rollback()
+            pool.putconn(conn)
+        except psycopg2.Error:
+            pool.putconn(conn, close=True)
+
+def prepare_statements(conn):
+    """
+    Executa o PREPARE de cada PREPARED_STATEMENTS separadamente (uma tentativa por conexão):
+    uma falha afeta só aquele comando, e a conexão não volta a tentar a cada empréstimo.
+    """
+    for name, sql in PREPARED_STATEMENTS.items():
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"PREPARE {name} AS {sql}")
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            st.error(f"Erro ao preparar o comando SQL '{name}': {e}")
+    conn.statements_prepared = True
+
+@st.cache_resource
+def apply_db_migrations():
+    """
+    Aplica as DB_MIGRATIONS ainda não registradas em app_migrations.
+    Conexão própria em autocommit (exigido pelo CREATE INDEX CONCURRENTLY): cada migração é
+    independente e só é registrada se der certo. O resultado fica em cache (inclusive as falhas);
+    quem decide quando tentar de novo é ensure_db_objects().
+    Retorna {'obrigatorias': [...], 'opcionais': [...], 'em': instante da tentativa}.
+    """
+    falhas_obrigatorias, falhas_opcionais = [], []
     try:
         conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except OperationalError as e:
-        st.error(f"Erro ao conectar ao Supabase (NOVA CONEXÃO): {e}")
-        return None
+    except psycopg2.Error as e:
+        falhas_obrigatorias.append(f"conexão: {e}")
+    else:
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS app_migrations (
+                        nome TEXT PRIMARY KEY,
+                        aplicada_em TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                """)
+                cursor.execute("SELECT nome FROM app_migrations")
+                aplicadas = {row[0] for row in cursor.fetchall()}
 
-def execute_query(sql, params=None, fetch=False):
-    """Executa comandos SQL e gerencia commit/rollback para operações simples."""
-    conn = get_db_connection_cached()
-    if conn is None:
-        return None
+                for nome, comandos, obrigatoria in DB_MIGRATIONS:
+                    if nome in aplicadas:
+                        continue
+                    try:
+                        for sql in ((comandos,) if isinstance(comandos, str) else comandos):
+                            cursor.execute(sql)
+                        cursor.execute("INSERT INTO app_migrations (nome) VALUES (%s)", (nome,))
+                    except psycopg2.Error as e:
+                        (falhas_obrigatorias if obrigatoria else falhas_opcionais).append(f"{nome}: {e}")
+        except psycopg2.Error as e:
+            falhas_obrigatorias.append(f"app_migrations: {e}")
+        finally:
+            conn.close()
+
+    return {'obrigatorias': falhas_obrigatorias, 'opcionais': falhas_opcionais, 'em': time.monotonic()}
+
+def ensure_db_objects():
+    """
+    Garante as views/índices/funções de DB_MIGRATIONS; retorna False se alguma obrigatória falhou.
+    Após uma falha obrigatória, nova tentativa só depois de MIGRATION_RETRY_SECONDS (não a cada rerun).
+    """
+    resultado = apply_db_migrations()
+    if resultado['obrigatorias'] and time.monotonic() - resultado['em'] >= MIGRATION_RETRY_SECONDS:
+        apply_db_migrations.clear()
+        resultado = apply_db_migrations()
+
+    if resultado['obrigatorias']:
+        st.error(
+            "Erro ao aplicar migrações do banco (telas de Produtos, Compras e Pedidos podem falhar): "
+            + "; ".join(resultado['obrigatorias'])
+        )
+        return False
+    if resultado['opcionais'] and not st.session_state.get("aviso_migracoes"):
+        st.session_state.aviso_migracoes = True
+        for falha in resultado['opcionais']:
+            st.warning(f"Migração opcional não aplicada: {falha}")
+    return True
+
+@st.cache_resource
+def _warm_up_pool():
+    with ExitStack() as stack:
+        for _ in range(POOL_MIN_CONN):
+            conn = stack.enter_context(get_conn())
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+    return True
+
+def warm_up_pool():
+    """
+    Empresta ao mesmo tempo as POOL_MIN_CONN conexões do pool e as prepara, tirando o custo do primeiro acesso.
+    Só o sucesso fica em cache: após uma falha, a próxima execução tenta de novo.
+    """
+    try:
+        return _warm_up_pool()
+    except psycopg2.Error as e:
+        st.error(f"Erro ao aquecer o pool de conexões: {e}")
+        return False
+
+def is_write_statement(sql):
+    """Indica se o SQL altera dados (INSERT/UPDATE/DELETE ou EXECUTE de um comando de PREPARED_WRITES)."""
+    head = sql.lstrip()
+    if head[:7].upper() == "EXECUTE":
+        name = re.match(r"\w*", head[7:].lstrip()).group(0).lower()
+        return name in PREPARED_WRITES
+    return head[:6].upper() in ("INSERT", "UPDATE", "DELETE")
+
+def execute_query(sql, params=None, fetch=False, tables=()):
+    """
+    Executa comandos SQL e gerencia commit/rollback para operações simples. Linhas lidas vêm como namedtuples.
+    Em escritas, `tables` indica as tabelas alteradas (só as leituras delas são invalidadas; vazio = todas as leituras e mapas de opções).
+    """
+    with get_conn() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
+            try:
+                cursor.execute(sql, params)
+
+                if is_write_statement(sql):
+                    conn.commit()
+                    invalidate_data_cache(*tables)
+                    return True
+
+                if fetch:
+                    return cursor.fetchall()
+
+                return True
+
+            except psycopg2.Error as e:
+                # Inclui ProgrammingError (ex.: comando preparado ausente nesta conexão), não só falhas de conexão
+                st.error(f"Erro ao executar a query: {e}. SQL: {sql}")
+                conn.rollback()
+                return None
+
+def fetch_dataframe(sql, params=None, stream=False):
+    """
+    Executa um SELECT e monta o DataFrame por colunas (cursor de tuplas, sem um dict por linha).
+    Com stream=True usa um cursor nomeado (server-side) e lê em lotes de FETCH_BATCH_SIZE linhas.
+    Em caso de erro exibe a mensagem e retorna None.
+    """
+    with get_conn() as conn:
+        with conn.cursor(name="fetch_dataframe" if stream else None) as cursor:
+            try:
+                cursor.execute(sql, params)
+                batch = cursor.fetchmany(FETCH_BATCH_SIZE) if stream else cursor.fetchall()
+                # Em cursores nomeados a descrição só existe após o primeiro fetch
+                columns = [col.name for col in cursor.description]
+                buffers = [[] for _ in columns]
+                while batch:
+                    for buffer, values in zip(buffers, zip(*batch)):
+                        buffer.extend(values)
+                    if not stream or len(batch) < FETCH_BATCH_SIZE:
+                        break
+                    batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+            except psycopg2.Error as e:
+                # Como em execute_query: inclui ProgrammingError (ex.: view de uma migração não aplicada)
+                st.error(f"Erro ao executar a query: {e}. SQL: {sql}")
+                return None
+
+    return pd.DataFrame(dict(zip(columns, buffers)))
+
+@st.cache_resource
+def get_table_versions():
+    """Versão de cada tabela, compartilhada entre sessões; incrementada a cada escrita na tabela."""
+    return {}
 
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+@st.cache_resource
+def get_table_versions_lock():
+    """Trava compartilhada que serializa os incrementos de get_table_versions() feitos pelas threads das sessões."""
+    return threading.Lock()
+
+# Chave de get_table_versions() incrementada por invalidate_data_cache() sem tabelas: muda a versão de todas
+ALL_TABLES = "*"
+
+def bump_table_version(table_name):
+    """Invalida as leituras cacheadas e os mapas de opções (get_options) que dependem de uma tabela, em todas as sessões."""
+    versions = get_table_versions()
+    with get_table_versions_lock():
+        versions[table_name] = versions.get(table_name, 0) + 1
+
+def table_versions(*tables):
+    """Versões atuais das tabelas indicadas (mais a de ALL_TABLES); entram na chave das leituras cacheadas abaixo."""
+    versions = get_table_versions()
+    return tuple(versions.get(table, 0) for table in (ALL_TABLES, *tables))
+
+class ReadError(Exception):
+    """Leitura que falhou (erro já exibido ao usuário)."""
+
+def read_or_raise(result):
+    """Levanta ReadError se a leitura falhou (None), para a falha não ficar guardada no st.cache_data."""
+    if result is None:
+        raise ReadError
+    return result
+
+# Leituras cacheadas: o argumento `version` (table_versions das tabelas lidas) só compõe a chave do cache,
+# assim uma escrita invalida apenas o que depende das tabelas alteradas. As funções _fetch_* levantam
+# ReadError em caso de erro (nada é cacheado); os wrappers públicos devolvem o resultado vazio.
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_all(table_name, columns, version):
+    select_cols = ", ".join(columns) if columns else "*"
+    sql = f"SELECT {select_cols} FROM {table_name}"
+    # Cursor nomeado só para a tabela inteira; leituras de poucas colunas (opções, lookups) evitam DECLARE/FETCH/CLOSE
+    return read_or_raise(fetch_dataframe(sql, stream=not columns))
 
-    result = None
-    
+def fetch_all(table_name, columns=None):
+    """Busca todos os registros de uma tabela (só as colunas indicadas em `columns`, se informadas)."""
     try:
-        cursor.execute(sql, params)
-        
-        if sql.strip().upper().startswith(("INSERT", "UPDATE", "DELETE")):
-            conn.commit()
-            # Limpa o cache se algo foi alterado
-            if sql.strip().upper().startswith("INSERT INTO Produtos"):
-                get_db_connection_cached.clear()
-            return True
-        
-        if fetch:
-            result = cursor.fetchall()
-            return result
-        
-        return True
-    
-    except OperationalError as e:
-        st.error(f"Erro ao executar a query: {e}. SQL: {sql}")
-        if conn:
-            conn.rollback() 
-        return None
-    finally:
-        cursor.close()
+        return _fetch_all(table_name, columns, table_versions(table_name))
+    except ReadError:
+        return pd.DataFrame()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_query(sql, params, version):
+    return read_or_raise(fetch_dataframe(sql, params=params))
 
-def fetch_all(table_name):
-    """Busca todos os registros de uma tabela."""
-    sql = f"SELECT * FROM {table_name}"
-    data = execute_query(sql, fetch=True)
-    return pd.DataFrame(data) if data else pd.DataFrame()
+def fetch_query(sql, params=None, tables=()):
+    """SELECT livre com resultado cacheado para as listas de pedidos; `tables` = tabelas lidas pelo SQL."""
+    try:
+        return _fetch_query(sql, params, table_versions(*tables))
+    except ReadError:
+        return pd.DataFrame()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_small(table_name, cap, version):
+    rows = read_or_raise(execute_query(f"SELECT * FROM {table_name} LIMIT {int(cap) + 1}", fetch=True))
+    if len(rows) > cap:
+        return _fetch_all(table_name, None, version)
+    return [row._asdict() for row in rows]
+
+def fetch_small(table_name, cap=200):
+    """
+    Tabelas de cadastro pequenas: devolve a lista de linhas (dicts) direto para o st.dataframe, sem montar DataFrame.
+    Acima de `cap` registros cai no fetch_all, para a lista nunca ser truncada.
+    """
+    try:
+        return _fetch_small(table_name, cap, table_versions(table_name))
+    except ReadError:
+        return []
 
-def fetch_data_for_display(table_name, columns, join_info=None, condition=None, params=None):
-    """Função genérica para buscar dados com joins e condição WHERE para exibição."""
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_data_for_display(table_name, columns, join_info, condition, params, order_by, limit, version):
     select_cols = ", ".join(columns)
     sql = f"SELECT {select_cols} FROM {table_name}"
-    
+
     if join_info:
         for join in join_info:
             sql += f" LEFT JOIN {join['table']} ON {join['on']}"
             
     if condition:
         sql += f" WHERE {condition}"
-            
-    data = execute_query(sql, params=params, fetch=True)
-    return pd.DataFrame(data) if data else pd.DataFrame()
-#-------------------------------------------------------------------------------------------------------------------------------------------
 
-# --- FUNÇÕES DE CUPOM NÃO FISCAL (NOVAS) ---
+    if order_by:
+        sql += f" ORDER BY {order_by}"
 
-def get_order_details_for_coupon(pedido_id):
-    """Busca os detalhes completos de um pedido (cabeçalho e itens) para impressão do cupom."""
-    
-    # SQL para buscar dados do cabeçalho do pedido
-    sql_header = """
-        SELECT P.pedido_id, C.nome AS cliente_nome, C.cpf_cnpj, 
-               P.data_pedido, P.valor_total, P.forma_pagamento
-        FROM Pedidos P
-        LEFT JOIN Clientes C ON P.cliente_id = C.cliente_id
-        WHERE P.pedido_id = %s
-    """
-    header_data = execute_query(sql_header, params=(pedido_id,), fetch=True)
-    
-    if not header_data:
-        return None
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+            
+    return read_or_raise(fetch_dataframe(sql, params=params))
 
-    # SQL para buscar os itens do pedido
-    sql_items = """
-        SELECT I.quantidade, I.preco_unitario, I.subtotal, 
-               Pr.descricao
-        FROM Vendas I
-        LEFT JOIN Produtos Pr ON I.produto_id = Pr.produto_id
-        WHERE I.pedido_id = %s
+def fetch_data_for_display(table_name, columns, join_info=None, condition=None, params=None, order_by=None, limit=None, tables=None):
+    """
+    Função genérica para buscar dados com joins, condição WHERE, ordenação e LIMIT para exibição.
+    `tables` = tabelas de origem (para views e joins); por padrão, só table_name.
     """
-    items_data = execute_query(sql_items, params=(pedido_id,), fetch=True)
-    
-    return {
-        'header': header_data[0],
-        'items': items_data
-    }
+    version = table_versions(*(tables or (table_name,)))
+    try:
+        return _fetch_data_for_display(table_name, columns, join_info, condition, params, order_by, limit, version)
+    except ReadError:
+        return pd.DataFrame()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _price_lookup(version):
+    df = _fetch_all("Produtos", ('produto_id', 'codigo_sku', 'descricao', 'marca', 'preco_custo', 'preco_venda'), version)
+    if df.empty:
+        return df
+    # marca (e demais partes) podem ser NULL: sem o fillna o str.cat devolveria NaN como rótulo
+    partes = df[['codigo_sku', 'descricao', 'marca']].fillna("").astype(str)
+    df['display_name'] = partes['codigo_sku'].str.cat(partes['descricao'], sep=" - ").str.cat(partes['marca'], sep=" (") + ")"
+    return df.set_index('produto_id')[['display_name', 'codigo_sku', 'descricao', 'marca', 'preco_custo', 'preco_venda']]
+
+def get_price_lookup():
+    """Produtos indexados por produto_id, com o rótulo "SKU - Descrição (Marca)" para a alteração de preços."""
+    try:
+        return _price_lookup(table_versions("Produtos"))
+    except ReadError:
+        return pd.DataFrame()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _produto_lookup(version):
+    df = _fetch_all("Produtos", ('produto_id', 'estoque_atual', 'preco_venda'), version)
+    if df.empty:
+        return {}
+    return df.set_index('produto_id')[['estoque_atual', 'preco_venda']].to_dict('index')
+
+def get_produto_lookup():
+    """Dict produto_id -> {'estoque_atual', 'preco_venda'} para o carrinho (busca O(1), sem filtrar o DataFrame)."""
+    try:
+        return _produto_lookup(table_versions("Produtos"))
+    except ReadError:
+        return {}
+
+def invalidate_data_cache(*tables):
+    """Após uma escrita no DB: invalida só as leituras das tabelas indicadas ou, sem tabelas, todas (inclusive get_options)."""
+    for table_name in (tables or (ALL_TABLES,)):
+        bump_table_version(table_name)
+
+def get_options(table_name, label_col, id_col):
+    """Mapa rótulo -> id para selectbox, guardado em st.session_state até a versão da tabela mudar."""
+    version = table_versions(table_name)
+    cache = st.session_state.setdefault(f"_opt_{table_name}_{label_col}", {})
+    if cache.get('ver') != version or 'map' not in cache:
+        try:
+            df = _fetch_all(table_name, (id_col, label_col), version)
+        except ReadError:
+            # Leitura falhou: nada é guardado na sessão, a próxima execução tenta de novo
+            return {}
+        cache['map'] = dict(zip(df[label_col], df[id_col])) if not df.empty else {}
+        cache['ver'] = version
+    return cache['map']
+#-------------------------------------------------------------------------------------------------------------------------------------------
 
+# --- FUNÇÕES DE CUPOM NÃO FISCAL (NOVAS) ---
 
-def generate_non_fiscal_coupon(pedido_id, order_details):
-    """
-    Gera o conteúdo HTML/Markdown do cupom não fiscal.
-    Usa um bloco de código pré-formatado e HTML para simular uma impressão.
-    """
-    
-    header = order_details['header']
-    items = order_details['items']
-    
-    # Formata a data e hora
-    data_formatada = header['data_pedido'].strftime('%d/%m/%Y %H:%M') if isinstance(header['data_pedido'], datetime) else str(header['data_pedido'])
-    
-    # Conteúdo HTML/CSS para simular o cupom de forma estreita
-    coupon_content = f"""
+# Linhas do cupom dos pedidos da CTE "alvo" (montada em conclude_orders_with_coupon): 'H' = cabeçalho de cada pedido, 'I' = itens
+COUPON_ROWS_SQL = """
+    SELECT 'H' AS tipo, P.pedido_id, C.nome AS cliente_nome, C.cpf_cnpj, 
+           P.data_pedido, P.valor_total, P.forma_pagamento,
+           NULL AS quantidade, NULL AS preco_unitario, NULL AS subtotal, NULL AS descricao
+    FROM alvo A
+    JOIN Pedidos P ON P.pedido_id = A.pedido_id
+    LEFT JOIN Clientes C ON P.cliente_id = C.cliente_id
+    UNION ALL
+    SELECT 'I', I.pedido_id, NULL, NULL, NULL, NULL, NULL,
+           I.quantidade, I.preco_unitario, I.subtotal, Pr.descricao
+    FROM alvo A
+    JOIN Vendas I ON I.pedido_id = A.pedido_id
+    LEFT JOIN Produtos Pr ON I.produto_id = Pr.produto_id
+"""
+
+def group_coupon_rows(rows):
+    """Agrupa as linhas de COUPON_ROWS_SQL em {pedido_id: {'header', 'items'}} (pedidos sem cabeçalho ficam de fora)."""
+    details = {row.pedido_id: {'header': row, 'items': []} for row in rows if row.tipo == 'H'}
+    for row in rows:
+        if row.tipo == 'I' and row.pedido_id in details:
+            details[row.pedido_id]['items'].append(row)
+    return details
+
+def conclude_orders_with_coupon(pedido_ids):
+    """Marca os pedidos como 'Concluído' e já devolve os detalhes dos cupons, num único comando (CTE com UPDATE ... RETURNING)."""
+    sql_concluir = """
+        WITH alvo AS (
+            UPDATE Pedidos SET status_pedido = 'Concluído'
+            WHERE pedido_id = ANY(%(pedido_ids)s)
+            RETURNING pedido_id
+        )
+    """ + COUPON_ROWS_SQL
+    with get_conn() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
+            try:
+                cursor.execute(sql_concluir, {'pedido_ids': [int(pid) for pid in pedido_ids]})
+                rows = cursor.fetchall()
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                st.error(f"Erro ao concluir pedidos: {e}")
+                return {}
+    invalidate_data_cache("Pedidos")
+    return group_coupon_rows(rows)
+
+
+# Modelo fixo do cupom; só os campos do pedido e as linhas de itens são substituídos
+COUPON_TEMPLATE = string.Template("""
 <div style="font-family: monospace; font-size: 10px; line-height: 1.2; width: 300px; margin: 0 auto; padding: 10px; border: 1px dashed black; background-color: #fff;">
     <h3 style="text-align: center; margin-bottom: 5px;">AUTOPEÇAS JACARÉ 🐊</h3>
     <p style="text-align: center; margin: 0;">CNPJ: 00.000.000/0001-00</p>
     <p style="text-align: center; margin: 0;">Rua Exemplo, 123 - Centro</p>
     <p style="text-align: center; margin-bottom: 10px;">(92) 99999-9999</p>
-    
+
     <p style="border-top: 1px dashed black; padding-top: 5px; margin: 5px 0 5px 0;">
         **CUPOM NÃO FISCAL**<br>
-        PEDIDO: **#{header['pedido_id']}**<br>
-        DATA: {data_formatada}<br>
-        CLIENTE: {header['cliente_nome']}<br>
-        CPF/CNPJ: {header['cpf_cnpj'] if header['cpf_cnpj'] else 'Não Informado'}<br>
+        PEDIDO: **#$pedido_id**<br>
+        DATA: $data<br>
+        CLIENTE: $cliente<br>
+        CPF/CNPJ: $cpf_cnpj<br>
     </p>
     <p style="border-top: 1px dashed black; padding-top: 5px; margin: 5px 0;">
         **ITENS DA VENDA:**<br>
-        DESCRIÇÃO | QTD | UNIT (R$) | TOTAL (R$)<br>
+        DESCRIÇÃO | QTD | UNIT (R$$) | TOTAL (R$$)<br>
         -------------------------------------------
     </p>
-    """
-    
-    # 2. Itens
-    for item in items:
-        # Formatação para simular coluna fixa
-        nome = item['descricao'][:15].ljust(15) 
-        qtd = f"{item['quantidade']:.0f}".rjust(3)
-        unit = f"{item['preco_unitario']:.2f}".rjust(9)
-        total = f"{item['subtotal']:.2f}".rjust(9)
-        
-        coupon_content += f"""
-        <p style="margin: 0;">{nome} | {qtd} | {unit} | {total}</p>
-        """
-        
-    # 3. Totais e Fechamento
-    coupon_content += f"""
+    $itens
     <p style="border-top: 1px dashed black; padding-top: 5px; margin: 5px 0;">
-        VALOR TOTAL: {f"R$ {header['valor_total']:.2f}".rjust(26)}<br>
-        FORMA PGTO: {header['forma_pagamento']}<br>
+        VALOR TOTAL: $valor_total<br>
+        FORMA PGTO: $forma_pagamento<br>
     </p>
     <p style="border-top: 1px dashed black; padding-top: 5px; text-align: center;">
         *** OBRIGADO PELA PREFERÊNCIA! ***<br>
@@ -192,8 +622,37 @@ def generate_non_fiscal_coupon(pedido_id, order_details):
         Verifique a garantia de seus produtos.
     </p>
 </div>
+    """)
+
+def generate_non_fiscal_coupon(pedido_id, order_details):
+    """
+    Gera o conteúdo HTML/Markdown do cupom não fiscal.
+    Usa um bloco de código pré-formatado e HTML para simular uma impressão.
     """
-    return coupon_content
+
+    header = order_details['header']
+    items = order_details['items']
+
+    # Formata a data e hora
+    data_formatada = header.data_pedido.strftime('%d/%m/%Y %H:%M') if isinstance(header.data_pedido, datetime) else str(header.data_pedido)
+
+    # Itens: uma linha por produto, colunas de largura fixa via format spec, unidas uma única vez
+    itens_html = "".join(
+        f"""
+        <p style="margin: 0;">{item.descricao:<15.15} | {item.quantidade:>3.0f} | {item.preco_unitario:>9.2f} | {item.subtotal:>9.2f}</p>
+        """
+        for item in items
+    )
+
+    return COUPON_TEMPLATE.substitute(
+        pedido_id=header.pedido_id,
+        data=data_formatada,
+        cliente=header.cliente_nome,
+        cpf_cnpj=header.cpf_cnpj if header.cpf_cnpj else 'Não Informado',
+        itens=itens_html,
+        valor_total=f"R$ {header.valor_total:.2f}".rjust(26),
+        forma_pagamento=header.forma_pagamento,
+    )
 
 
 #-------------------------------------------------------------------------------------------------------------------------------------------
@@ -202,6 +661,10 @@ def generate_non_fiscal_coupon(pedido_id, order_details):
 
 st.set_page_config(layout="wide", page_title="ERP de Peças de Motos (Supabase)")
 
+# Sem as migrações obrigatórias, as telas que leem as views (Produtos, Compras) não consultam o banco
+db_objects_ok = ensure_db_objects()
+warm_up_pool()
+
 st.markdown(
     """
     <h1 style="text-align: center;">🏍️ Moto Peças Jacaré 🐊</h1>
@@ -252,7 +715,7 @@ try:
         """,
         unsafe_allow_html=True
     )
-    
+
     st.sidebar.image("logomarca.png", use_column_width=True) 
 
 except FileNotFoundError:
@@ -278,12 +741,9 @@ if choice == "Clientes":
             
             if submitted:
                 if nome and cpf_cnpj:
-                    sql = """
-                        INSERT INTO Clientes (nome, cpf_cnpj, telefone, email, endereco, created_at)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """
+                    sql = "EXECUTE ins_cliente (%s, %s, %s, %s, %s, %s)"
                     params = (nome, cpf_cnpj, telefone, email, endereco, data_cadastro)
-                    if execute_query(sql, params):
+                    if execute_query(sql, params, tables=("Clientes",)):
                         st.success(f"Cliente '{nome}' cadastrado com sucesso no DB!")
                         st.rerun()
                     else:
@@ -292,9 +752,9 @@ if choice == "Clientes":
                     st.error("Nome e CPF/CNPJ são obrigatórios.")
 
     st.subheader("Lista de Clientes")
-    df_clientes = fetch_all("Clientes")
-    if not df_clientes.empty:
-        st.dataframe(df_clientes)
+    lista_clientes = fetch_small("Clientes")
+    if len(lista_clientes):
+        st.dataframe(lista_clientes)
     else:
         st.info("Nenhum cliente cadastrado no banco de dados.")
 
@@ -304,7 +764,7 @@ if choice == "Clientes":
 elif choice == "Fornecedores":
     # ... (código Fornecedores) ...
     st.header("Cadastro de Fornecedores")
-    
+
     with st.expander("➕ Novo Fornecedor"):
         with st.form("form_fornecedor"):
             nome_fantasia = st.text_input("Nome Fantasia", key='nome_f')
@@ -318,12 +778,9 @@ elif choice == "Fornecedores":
             
             if submitted:
                 if nome_fantasia and cnpj:
-                    sql = """
-                        INSERT INTO Fornecedores (nome_fantasia, cnpj, telefone, email, contato)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """
+                    sql = "EXECUTE ins_fornecedor (%s, %s, %s, %s, %s)"
                     params = (nome_fantasia, cnpj, telefone, email, contato)
-                    if execute_query(sql, params):
+                    if execute_query(sql, params, tables=("Fornecedores",)):
                         st.success(f"Fornecedor '{nome_fantasia}' cadastrado com sucesso no DB!")
                         st.rerun()
                     else:
@@ -332,9 +789,9 @@ elif choice == "Fornecedores":
                     st.error("Nome Fantasia e CNPJ são obrigatórios.")
 
     st.subheader("Lista de Fornecedores")
-    df_fornecedores = fetch_all("Fornecedores")
-    if not df_fornecedores.empty:
-        st.dataframe(df_fornecedores)
+    lista_fornecedores = fetch_small("Fornecedores")
+    if len(lista_fornecedores):
+        st.dataframe(lista_fornecedores)
     else:
         st.info("Nenhum fornecedor cadastrado no banco de dados.")
 
@@ -344,7 +801,7 @@ elif choice == "Fornecedores":
 elif choice == "Categorias":
     # ... (código Categorias) ...
     st.header("Cadastro de Categorias de Peças")
-    
+
     with st.expander("➕ Nova Categoria"):
         with st.form("form_categoria"):
             nome_categoria = st.text_input("Nome da Categoria (Ex: Motor, Suspensão, Elétrica)", key='nome_cat')
@@ -353,9 +810,9 @@ elif choice == "Categorias":
             
             if submitted:
                 if nome_categoria:
-                    sql = "INSERT INTO Categorias (nome_categoria) VALUES (%s)"
+                    sql = "EXECUTE ins_categoria (%s)"
                     params = (nome_categoria,)
-                    if execute_query(sql, params):
+                    if execute_query(sql, params, tables=("Categorias",)):
                         st.success(f"Categoria '{nome_categoria}' cadastrada com sucesso!")
                         st.rerun() 
                     else:
@@ -364,9 +821,9 @@ elif choice == "Categorias":
                     st.error("O nome da categoria é obrigatório.")
 
     st.subheader("Lista de Categorias")
-    df_categorias = fetch_all("Categorias")
-    if not df_categorias.empty:
-        st.dataframe(df_categorias)
+    lista_categorias = fetch_small("Categorias")
+    if len(lista_categorias):
+        st.dataframe(lista_categorias)
     else:
         st.info("Nenhuma categoria cadastrada no banco de dados.")
 
@@ -375,16 +832,14 @@ elif choice == "Categorias":
 # ------------ CADASTRO DE PRODUTOS -------------------
 elif choice == "Produtos (Estoque)":
     st.header("Cadastro de Peças e Controle de Estoque")
-    
-    df_categorias = fetch_all("Categorias")
-    df_fornecedores = fetch_all("Fornecedores")
-    df_produtos_full = fetch_all("Produtos") # Buscando produtos para a lista de preços
-    
-    if df_categorias.empty or df_fornecedores.empty:
+
+    opcoes_categorias = get_options("Categorias", 'nome_categoria', 'categoria_id')
+    opcoes_fornecedores = get_options("Fornecedores", 'nome_fantasia', 'fornecedor_id')
+    df_precos = get_price_lookup() # Produtos indexados por produto_id para a lista de preços
+
+    if not opcoes_categorias or not opcoes_fornecedores:
         st.warning("⚠️ Atenção! É necessário cadastrar Categorias e Fornecedores antes de cadastrar Produtos.")
     else:
-        opcoes_categorias = dict(zip(df_categorias['nome_categoria'], df_categorias['categoria_id']))
-        opcoes_fornecedores = dict(zip(df_fornecedores['nome_fantasia'], df_fornecedores['fornecedor_id']))
         
         # --- BLOCO 1: NOVO PRODUTO ---
         with st.expander("➕ Novo Produto (Cadastro Inicial)"):
@@ -414,13 +869,10 @@ elif choice == "Produtos (Estoque)":
                         cat_id = opcoes_categorias[categoria_selecionada]
                         forn_id = opcoes_fornecedores[fornecedor_selecionado]
                         
-                        sql = """
-                            INSERT INTO Produtos (codigo_sku, descricao, marca, preco_custo, preco_venda, estoque_atual, estoque_minimo, categoria_id, fornecedor_id, modelo_moto, ano_moto)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        """
+                        sql = "EXECUTE ins_produto (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
                         params = (codigo_sku, descricao, marca, preco_custo, preco_venda, int(estoque_atual), int(estoque_minimo), cat_id, forn_id, modelo_moto, ano_moto)
                         
-                        if execute_query(sql, params):
+                        if execute_query(sql, params, tables=("Produtos",)):
                             st.success(f"Produto SKU '{codigo_sku}' cadastrado com sucesso!")
                             st.rerun()
                         else:
@@ -428,19 +880,18 @@ elif choice == "Produtos (Estoque)":
 
         # --- BLOCO 2: ALTERAÇÃO DE PREÇOS ---
         with st.expander("💰 Atualizar Preços de Produtos Existentes"):
-            if df_produtos_full.empty:
+            if df_precos.empty:
                 st.info("Nenhum produto cadastrado para alterar preços.")
             else:
                 # Criar uma lista de seleção formatada: "SKU - Descrição (Marca)"
-                df_produtos_full['display_name'] = df_produtos_full['codigo_sku'] + " - " + df_produtos_full['descricao'] + " (" + df_produtos_full['marca'] + ")"
-                opcoes_alterar_preco = dict(zip(df_produtos_full['display_name'], df_produtos_full['produto_id']))
+                opcoes_alterar_preco = dict(zip(df_precos['display_name'], df_precos.index))
                 
                 with st.form("form_alterar_preco"):
                     produto_selecionado_label = st.selectbox("Selecione o Produto para Alterar Preço", list(opcoes_alterar_preco.keys()))
                     produto_id_update = opcoes_alterar_preco[produto_selecionado_label]
                     
                     # Pegar dados atuais do produto selecionado para preencher os campos
-                    dados_atuais = df_produtos_full[df_produtos_full['produto_id'] == produto_id_update].iloc[0]
+                    dados_atuais = df_precos.loc[produto_id_update]
                     
                     col_u1, col_u2 = st.columns(2)
                     novo_preco_custo = col_u1.number_input("Novo Preço Custo (R$)", min_value=0.0, format="%.2f", value=float(dados_atuais['preco_custo']))
@@ -450,7 +901,7 @@ elif choice == "Produtos (Estoque)":
                     
                     if btn_update_preco:
                         sql_update = "UPDATE Produtos SET preco_custo = %s, preco_venda = %s WHERE produto_id = %s"
-                        if execute_query(sql_update, (novo_preco_custo, novo_preco_venda, produto_id_update)):
+                        if execute_query(sql_update, (novo_preco_custo, novo_preco_venda, produto_id_update), tables=("Produtos",)):
                             st.success(f"Preços de '{produto_selecionado_label}' atualizados!")
                             st.rerun()
                         else:
@@ -459,36 +910,33 @@ elif choice == "Produtos (Estoque)":
         # --- BLOCO 3: VISUALIZAÇÃO DA TABELA ---
         st.subheader("Estoque Atual de Produtos")
         
-        join_columns = [
-            "P.codigo_sku", "P.marca", "P.descricao", "P.ano_moto",
-            "P.preco_custo", "P.preco_venda", "P.estoque_atual", "P.estoque_minimo", 
-            "C.nome_categoria", "F.nome_fantasia AS fornecedor", "P.ativo as status",
-        ]
-        join_info = [
-            {'table': 'Categorias C', 'on': 'P.categoria_id = C.categoria_id'},
-            {'table': 'Fornecedores F', 'on': 'P.fornecedor_id = F.fornecedor_id'}
-        ]
-        
-        df_produtos_display = fetch_data_for_display("Produtos P", join_columns, join_info)
-        
-        if not df_produtos_display.empty:
-            st.dataframe(df_produtos_display)
+        # Join com Categorias e Fornecedores fica na view v_produtos_display (ver DB_MIGRATIONS)
+        if not db_objects_ok:
+            st.info("Estoque indisponível: a view v_produtos_display depende das migrações do banco (ver erro acima).")
         else:
-            st.info("Nenhum produto cadastrado no banco de dados.")
+            df_produtos_display = fetch_data_for_display(
+                "v_produtos_display", ["*"], order_by="descricao", limit=DISPLAY_ROW_LIMIT,
+                tables=("Produtos", "Categorias", "Fornecedores")
+            )
+
+            if not df_produtos_display.empty:
+                st.dataframe(df_produtos_display)
+                if len(df_produtos_display) >= DISPLAY_ROW_LIMIT:
+                    st.caption(f"Exibindo os primeiros {DISPLAY_ROW_LIMIT} produtos (ordem alfabética).")
+            else:
+                st.info("Nenhum produto cadastrado no banco de dados.")
 #-------------------------------------------------------------------------------------------------------------------------------------------
 
 # --- MÓDULO: COMPRAS E RECEBIMENTO DE ESTOQUE ---
 elif choice == "Compras e Recebimento de Estoque":
     st.header("📦 Registro de Compras e Recebimento de Mercadorias")
-    
-    df_fornecedores = fetch_all("Fornecedores")
-    df_produtos = fetch_all("Produtos")
 
-    if df_fornecedores.empty or df_produtos.empty:
+    opcoes_fornecedores = get_options("Fornecedores", 'nome_fantasia', 'fornecedor_id')
+    opcoes_produtos = get_options("Produtos", 'descricao', 'produto_id')
+
+    if not opcoes_fornecedores or not opcoes_produtos:
         st.warning("⚠️ É necessário ter Fornecedores e Produtos cadastrados para registrar entradas.")
     else:
-        opcoes_fornecedores = dict(zip(df_fornecedores['nome_fantasia'], df_fornecedores['fornecedor_id']))
-        opcoes_produtos = dict(zip(df_produtos['descricao'], df_produtos['produto_id']))
         
         with st.form("form_entrada_estoque"):
             st.subheader("Lançamento de Nota Fiscal/Compra")
@@ -534,120 +982,72 @@ elif choice == "Compras e Recebimento de Estoque":
                     produto_id = opcoes_produtos[produto_selecionado]
                     fornecedor_id = opcoes_fornecedores[fornecedor_selecionado]
                     
-                    conn = get_db_connection_new()
-                    if conn is None:
-                        st.error("Conexão com o banco de dados indisponível.")
-                        st.stop()
+                    with get_conn() as conn, conn.cursor() as cursor:
+                        try:
+                            # Histórico (Entradas) + estoque e custo médio (Produtos) numa única ida ao banco
+                            sql_entrada = "EXECUTE receber_entrada (%s, %s, %s, %s, %s, %s, %s)"
+                            params_compra = (
+                                produto_id, fornecedor_id, 
+                                data_recebimento_input, data_emissao_input, 
+                                int(quantidade_entrada), 
+                                valor_unitario_compra, nota_fiscal
+                            )
+                            cursor.execute(sql_entrada, params_compra)
+                            resultado = cursor.fetchone()
                         
-                    cursor = conn.cursor()
-
-                    try:
-                        # 1. Busca dados atuais (Corrigido para usar índices numéricos)
-                        sql_dados_atuais = "SELECT estoque_atual, preco_custo FROM Produtos WHERE produto_id = %s"
-                        cursor.execute(sql_dados_atuais, (produto_id,))
-                        resultado = cursor.fetchone()
-                        
-                        if not resultado:
-                            st.error("Produto não encontrado no DB.")
-                            st.stop()
+                            if not resultado:
+                                st.error("Produto não encontrado no DB.")
+                                st.stop()
                             
-                        estoque_atual_db = int(resultado[0]) if resultado[0] is not None else 0
-                        custo_atual_db = float(resultado[1]) if resultado[1] is not None else 0.0
-                        
-                        quantidade_entrada_int = int(quantidade_entrada)
-                        
-                        # --- TRANSAÇÃO 1: REGISTRO NO HISTÓRICO (Coluna: emissao) ---
-                        sql_insert_compra = """
-                            INSERT INTO Entradas (produto_id, fornecedor_id, data_recebimento, emissao, quantidade_comprada, valor_unitario_compra, numero_nota_fiscal)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s)
-                        """
-                        params_compra = (
-                            produto_id, fornecedor_id, 
-                            data_recebimento_input, data_emissao_input, 
-                            quantidade_entrada_int, 
-                            valor_unitario_compra, nota_fiscal
-                        )
-                        cursor.execute(sql_insert_compra, params_compra)
-                        
-                        # --- CÁLCULO DO CUSTO MÉDIO ---
-                        valor_total_antigo = estoque_atual_db * custo_atual_db
-                        valor_total_novo = quantidade_entrada_int * valor_unitario_compra
-                        novo_estoque = estoque_atual_db + quantidade_entrada_int
-                        
-                        if novo_estoque > 0:
-                            novo_custo_medio = (valor_total_antigo + valor_total_novo) / novo_estoque
-                        else:
-                            novo_custo_medio = valor_unitario_compra
-
-                        # --- TRANSAÇÃO 2: ATUALIZAÇÃO DO PRODUTO ---
-                        sql_update_estoque = """
-                            UPDATE Produtos 
-                            SET estoque_atual = %s, preco_custo = %s 
-                            WHERE produto_id = %s
-                        """
-                        cursor.execute(sql_update_estoque, (novo_estoque, round(novo_custo_medio, 4), produto_id))
+                            novo_estoque = resultado[0]
                         
-                        conn.commit()
-                        st.success(f"Estoque atualizado! Novo saldo: {novo_estoque}")
-                        st.rerun()
+                            conn.commit()
+                            invalidate_data_cache("Entradas", "Produtos")
+                            st.success(f"Estoque atualizado! Novo saldo: {novo_estoque}")
+                            st.rerun()
 
-                    except Exception as e:
-                        if conn: conn.rollback()
-                        st.error(f"Erro ao processar transação: {e}")
-                    finally:
-                        if cursor: cursor.close()
-                        if conn: conn.close() 
+                        except Exception as e:
+                            conn.rollback()
+                            st.error(f"Erro ao processar transação: {e}")
 
         st.markdown("---")
         st.subheader("Histórico de Entradas de Estoque")
 
-        # Colunas para o Histórico (ajustado para 'emissao')
+        # Join com Produtos e Fornecedores fica na view v_entradas_historico; datas formatadas pelo Postgres
         historico_cols = [
-            "F.nome_fantasia AS Fornecedor", 
-            "P.descricao AS Produto", 
-            "E.emissao", "E.data_recebimento", 
-            "E.quantidade_comprada", "E.valor_unitario_compra", 
-            "E.numero_nota_fiscal"
-        ]
-        historico_join = [
-            {'table': 'Produtos P', 'on': 'E.produto_id = P.produto_id'},
-            {'table': 'Fornecedores F', 'on': 'E.fornecedor_id = F.fornecedor_id'}
+            "V.fornecedor", "V.produto",
+            "TO_CHAR(V.emissao, 'DD/MM/YYYY') AS emissao",
+            "TO_CHAR(V.data_recebimento, 'DD/MM/YYYY') AS data_recebimento",
+            "V.quantidade_comprada", "V.valor_unitario_compra",
+            "V.numero_nota_fiscal"
         ]
         
-        df_historico = fetch_data_for_display("Entradas E", historico_cols, historico_join)
+        if not db_objects_ok:
+            st.info("Histórico indisponível: a view v_entradas_historico depende das migrações do banco (ver erro acima).")
+        else:
+            df_historico = fetch_data_for_display(
+                "v_entradas_historico V", historico_cols,
+                order_by="V.data_recebimento DESC", limit=DISPLAY_ROW_LIMIT,
+                tables=("Entradas", "Produtos", "Fornecedores")
+            )
 
-        if not df_historico.empty:
-            # Formatação das colunas de data
-            for col_data in ['emissao', 'data_recebimento']:
-                if col_data in df_historico.columns:
-                    df_historico[col_data] = pd.to_datetime(df_historico[col_data]).dt.strftime('%d/%m/%Y')
-            
-            st.dataframe(df_historico.rename(columns={
-                'emissao': 'Data Emissão',
-                'data_recebimento': 'Data Recebimento',
-                'quantidade_comprada': 'Qtd.',
-                'valor_unitario_compra': 'Custo Un. (R$)',
-                'numero_nota_fiscal': 'NF'
-            }))
+            if not df_historico.empty:
+                st.dataframe(df_historico.rename(columns={
+                    'emissao': 'Data Emissão',
+                    'data_recebimento': 'Data Recebimento',
+                    'quantidade_comprada': 'Qtd.',
+                    'valor_unitario_compra': 'Custo Un. (R$)',
+                    'numero_nota_fiscal': 'NF'
+                }))
+                if len(df_historico) >= DISPLAY_ROW_LIMIT:
+                    st.caption(f"Exibindo as {DISPLAY_ROW_LIMIT} entradas mais recentes.")
 
 #-------------------------------------------------------------------------------------------------------------------------------------------
 
 # --- MÓDULO: PEDIDOS DE VENDA (Com Opção de Cupom Não Fiscal) ---
 
-# Função para gerar o HTML do orçamento
-def gerar_orcamento_html(cliente, itens, valor_total):
-    linhas = ""
-    for item in itens:
-        linhas += f"""
-        <tr>
-            <td>{item['produto_nome']}</td>
-            <td style="text-align:center">{item['quantidade']}</td>
-            <td style="text-align:right">R$ {item['preco_unit']:.2f}</td>
-            <td style="text-align:right">R$ {item['subtotal']:.2f}</td>
-        </tr>
-        """
-
-    html = f"""
+# Página do orçamento (CSS com chaves duplicadas por causa do str.format)
+ORCAMENTO_HTML = """
     <html>
     <head>
         <style>
@@ -684,7 +1084,7 @@ def gerar_orcamento_html(cliente, itens, valor_total):
         <h2>ORÇAMENTO</h2>
 
         <div class="info"><strong>Cliente:</strong> {cliente}</div>
-        <div class="info"><strong>Data:</strong> {datetime.now().strftime('%d/%m/%Y %H:%M')}</div>
+        <div class="info"><strong>Data:</strong> {data}</div>
 
         <table>
             <thead>
@@ -708,10 +1108,31 @@ def gerar_orcamento_html(cliente, itens, valor_total):
     </body>
     </html>
     """
-    return html
+
+# Função para gerar o HTML do orçamento
+def gerar_orcamento_html(cliente, itens, valor_total):
+    linhas = "".join(
+        f"""
+        <tr>
+            <td>{item['produto_nome']}</td>
+            <td style="text-align:center">{item['quantidade']}</td>
+            <td style="text-align:right">R$ {item['preco_unit']:.2f}</td>
+            <td style="text-align:right">R$ {item['subtotal']:.2f}</td>
+        </tr>
+        """
+        for item in itens
+    )
+
+    return ORCAMENTO_HTML.format(
+        cliente=cliente,
+        data=datetime.now().strftime('%d/%m/%Y %H:%M'),
+        linhas=linhas,
+        valor_total=valor_total,
+    )
 
 if "vendas" not in st.session_state:
     st.session_state.vendas = []
+    st.session_state.total_vendas = 0.0
 
 elif choice == "Pedidos de Venda":
     from datetime import datetime
@@ -721,43 +1142,53 @@ elif choice == "Pedidos de Venda":
     # ---------- SESSION STATE ----------
     if "vendas" not in st.session_state:
         st.session_state.vendas = []
+    # Total do carrinho mantido incrementalmente (somado ao adicionar, zerado ao limpar/registrar)
+    if "total_vendas" not in st.session_state:
+        st.session_state.total_vendas = sum(item['subtotal'] for item in st.session_state.vendas)
 
     # ---------- DADOS ----------
-    df_clientes = fetch_all("Clientes")
-    df_produtos = fetch_all("Produtos")
+    # Mapas de opções reaproveitados da sessão enquanto as tabelas não mudam (get_options)
+    opcoes_clientes = get_options("Clientes", 'nome', 'cliente_id')
+    opcoes_produtos = get_options("Produtos", 'descricao', 'produto_id')
 
-    if df_clientes.empty or df_produtos.empty:
+    if not opcoes_clientes or not opcoes_produtos:
         st.warning("É necessário ter Clientes e Produtos cadastrados no DB.")
         st.stop()
 
-    opcoes_clientes = dict(zip(df_clientes['nome'], df_clientes['cliente_id']))
-    opcoes_produtos = dict(zip(df_produtos['descricao'], df_produtos['produto_id']))
+    produto_por_id = get_produto_lookup()
 
     # ==========================================================
     # 🔍 CONSULTA DE ESTOQUE (ANTES DA VENDA)
     # ==========================================================
     with st.expander("🔍 Consulta Rápida de Estoque", expanded=False):
 
-        termo_busca = st.text_input(
-            "Digite o nome do produto para pesquisar",
-            placeholder="Ex: Pastilha, Óleo, Corrente..."
-        )
-
-        if termo_busca:
-            filtro = df_produtos[
-                df_produtos['descricao'].str.contains(termo_busca, case=False, na=False)
-            ]
+        # Form: digitar não dispara rerun; a busca roda só ao clicar em Buscar (ou Enter)
+        with st.form("busca_estoque", clear_on_submit=False):
+            termo_busca = st.text_input(
+                "Digite o nome do produto para pesquisar",
+                placeholder="Ex: Pastilha, Óleo, Corrente..."
+            )
+            st.form_submit_button("🔍 Buscar")
+
+        termo_busca = termo_busca.strip()
+        if len(termo_busca) >= 3:
+            # Filtro no Postgres (índice de trigramas), só as colunas exibidas e no máximo 50 linhas
+            termo_like = termo_busca.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            filtro = fetch_data_for_display(
+                "Produtos",
+                ['descricao AS "Produto"', 'marca', 'estoque_atual AS "Estoque Atual"', 'preco_venda AS "Preço de Venda"'],
+                condition="descricao ILIKE %s",
+                params=(f"%{termo_like}%",),
+                order_by="descricao",
+                limit=50
+            )
 
             if filtro.empty:
                 st.warning("Nenhum produto encontrado.")
             else:
-                st.dataframe(
-                    filtro[['descricao', 'marca', 'estoque_atual', 'preco_venda']].rename(columns={
-                        'descricao': 'Produto',
-                        'estoque_atual': 'Estoque Atual',
-                        'preco_venda': 'Preço de Venda'
-                    })
-                )
+                st.dataframe(filtro)
+        elif termo_busca:
+            st.info("Digite ao menos 3 letras para consultar o estoque.")
         else:
             st.info("Digite algo para consultar o estoque.")
 
@@ -782,67 +1213,74 @@ elif choice == "Pedidos de Venda":
 
         st.subheader("Adicionar Produtos")
 
-        # 🚨 ALTERAÇÃO: Usaremos 4 colunas agora
-        col1, col2, col3, col4 = st.columns(4) 
+        # Widgets do item num form: só o botão de adicionar dispara o rerun (e os campos são limpos)
+        with st.form("add_item", clear_on_submit=True):
+            # 🚨 ALTERAÇÃO: Usaremos 4 colunas agora
+            col1, col2, col3, col4 = st.columns(4) 
         
-        with col1:
-            produto_item = st.selectbox(
-                "Produto",
-                options=list(opcoes_produtos.keys()),
-                index=None,
-                placeholder="Digite ou selecione o produto"
-            )
+            with col1:
+                produto_item = st.selectbox(
+                    "Produto",
+                    options=list(opcoes_produtos.keys()),
+                    index=None,
+                    placeholder="Digite ou selecione o produto"
+                )
         
-        with col2:
-            quantidade_item = st.number_input(
-                "Quantidade",
-                min_value=1,
-                step=1,
-                value=None,          # ← começa vazio
-                key="qtd_item"
-            )
+            with col2:
+                quantidade_item = st.number_input(
+                    "Quantidade",
+                    min_value=1,
+                    step=1,
+                    value=None,          # ← começa vazio
+                    key="qtd_item"
+                )
 
         
-        with col3:
-            percentual_desconto = st.number_input(
-                "Desconto (%)",
-                min_value=0.0,
-                max_value=100.0,
-                value=None,         
-                step=0.5,
-                format="%.2f",
-                key="desc_perc"
-            )
+            with col3:
+                percentual_desconto = st.number_input(
+                    "Desconto (%)",
+                    min_value=0.0,
+                    max_value=100.0,
+                    value=None,         
+                    step=0.5,
+                    format="%.2f",
+                    key="desc_perc"
+                )
         
-        with col4:
-            st.text("") # Espaço para alinhar o botão
-            if st.button("➕ Adicionar Item"):
-                produto_id = opcoes_produtos[produto_item]
-                produto_data = df_produtos[df_produtos['produto_id'] == produto_id].iloc[0]
-
-                estoque_atual = int(produto_data['estoque_atual'])
-                preco_venda_original = float(produto_data['preco_venda'])
+            with col4:
+                st.text("") # Espaço para alinhar o botão
+                if st.form_submit_button("➕ Adicionar Item"):
+                    # Validação antes de consultar os mapas: sem produto/quantidade não há o que adicionar
+                    if not produto_item or not quantidade_item:
+                        st.warning("Selecione o produto e informe a quantidade.")
+                    else:
+                        produto_id = opcoes_produtos[produto_item]
+                        produto_data = produto_por_id[produto_id]
+
+                        estoque_atual = int(produto_data['estoque_atual'])
+                        preco_venda_original = float(produto_data['preco_venda'])
                 
-                # 🚨 CÁLCULO DO PREÇO COM DESCONTO
-                fator_desconto = 1 - (percentual_desconto / 100)
-                preco_unit_com_desconto = preco_venda_original * fator_desconto
+                        # 🚨 CÁLCULO DO PREÇO COM DESCONTO
+                        fator_desconto = 1 - ((percentual_desconto or 0.0) / 100)
+                        preco_unit_com_desconto = preco_venda_original * fator_desconto
                 
-                subtotal_item = preco_unit_com_desconto * int(quantidade_item)
+                        subtotal_item = preco_unit_com_desconto * int(quantidade_item)
 
-                if quantidade_item > estoque_atual:
-                    st.error(f"Estoque insuficiente! Disponível: {estoque_atual}")
-                else:
-                    # 🚨 ALTERAÇÃO: Adicionando dados do desconto no Session State para exibição
-                    st.session_state.vendas.append({
-                        "produto_id": produto_id,
-                        "produto_nome": produto_item,
-                        "quantidade": int(quantidade_item),
-                        "preco_unit_original": preco_venda_original,     
-                        "desconto_perc": percentual_desconto, 
-                        "preco_unit": preco_unit_com_desconto,
-                        "subtotal": subtotal_item                    
-                    })
-                    st.success("Item adicionado ao pedido.")
+                        if quantidade_item > estoque_atual:
+                            st.error(f"Estoque insuficiente! Disponível: {estoque_atual}")
+                        else:
+                            # 🚨 ALTERAÇÃO: Adicionando dados do desconto no Session State para exibição
+                            st.session_state.vendas.append({
+                                "produto_id": produto_id,
+                                "produto_nome": produto_item,
+                                "quantidade": int(quantidade_item),
+                                "preco_unit_original": preco_venda_original,     
+                                "desconto_perc": percentual_desconto or 0.0, 
+                                "preco_unit": preco_unit_com_desconto,
+                                "subtotal": subtotal_item                    
+                            })
+                            st.session_state.total_vendas += subtotal_item
+                            st.success("Item adicionado ao pedido.")
 
         # ---------- CARRINHO ----------
         if st.session_state.vendas:
@@ -868,13 +1306,14 @@ elif choice == "Pedidos de Venda":
                 }
             )
 
-            valor_total = df_itens['subtotal'].sum()
+            valor_total = st.session_state.total_vendas
             st.metric("💰 Valor Total (c/ Descontos)", f"R$ {valor_total:.2f}")
 
             col_a, col_b, col_c = st.columns(3)
             with col_a:
                 if st.button("🗑️ Limpar Itens"):
                     st.session_state.vendas = []
+                    st.session_state.total_vendas = 0.0
                     st.rerun()
 
             with col_b:
@@ -888,67 +1327,46 @@ elif choice == "Pedidos de Venda":
 
             with col_c:
                 if st.button("📌 Registrar Pedido", type="primary"):
-                    try:
-                        conn = get_db_connection_new()
-                        cursor = conn.cursor()
-
-                        data_pedido = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        cliente_id = opcoes_clientes[cliente_selecionado]
-
-                        # CORREÇÃO 1: Converter valor_total para float nativo
-                        valor_total_float = float(valor_total)
-
-                        cursor.execute("""
-                            INSERT INTO Pedidos
-                            (cliente_id, data_pedido, valor_total, status_pedido, forma_pagamento)
-                            VALUES (%s, %s, %s, %s, %s)
-                            RETURNING pedido_id
-                        """, (cliente_id, data_pedido, valor_total_float, 'Pendente', forma_pagamento))
-
-                        # No PostgreSQL/Supabase, usamos fetchone para pegar o ID gerado
-                        pedido_id = cursor.fetchone()[0]
-
-                        for item in st.session_state.vendas:
-                            # CORREÇÃO 2: Converter todos os valores do item para tipos nativos
-                            qtd = int(item['quantidade'])
-                            preco_unit = float(item['preco_unit'])
-                            subtotal = float(item['subtotal'])
-                            desconto_p = float(item['desconto_perc'])
-                            prod_id = int(item['produto_id'])
-
-                            cursor.execute("""
-                                INSERT INTO Vendas
-                                (pedido_id, produto_id, quantidade, preco_unitario, subtotal, desconto)
-                                VALUES (%s, %s, %s, %s, %s, %s)
-                            """, (
-                                pedido_id,
-                                prod_id,
-                                qtd,
-                                preco_unit,
-                                subtotal,
-                                desconto_p
-                            ))
-
-                            # Atualização de estoque
-                            cursor.execute("""
-                                UPDATE Produtos
-                                SET estoque_atual = estoque_atual - %s
-                                WHERE produto_id = %s
-                            """, (qtd, prod_id))
-
-                        conn.commit()
-
-                        st.success(f"Pedido #{pedido_id} registrado com sucesso!")
-                        st.session_state.vendas = []
-                        get_db_connection_cached.clear()
-                        st.rerun()
+                    with get_conn() as conn, conn.cursor() as cursor:
+                        try:
+                            data_pedido = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                            cliente_id = opcoes_clientes[cliente_selecionado]
+
+                            # Itens com tipos nativos (JSON); cabeçalho (com o valor total exibido), itens e estoque são gravados pela função create_pedido
+                            itens_json = json.dumps([
+                                {
+                                    "produto_id": int(item['produto_id']),
+                                    "quantidade": int(item['quantidade']),
+                                    "preco_unit": float(item['preco_unit']),
+                                    "subtotal": float(item['subtotal']),
+                                    "desconto_perc": float(item['desconto_perc'])
+                                }
+                                for item in st.session_state.vendas
+                            ])
+
+                            cursor.execute(
+                                "SELECT create_pedido(%s, %s, %s::jsonb, %s, %s)",
+                                (cliente_id, forma_pagamento, itens_json, data_pedido, float(valor_total))
+                            )
+
+                            # A função retorna o ID gerado
+                            pedido_id = cursor.fetchone()[0]
+
+                            conn.commit()
+                            invalidate_data_cache("Pedidos", "Vendas", "Produtos")
+
+                            st.success(f"Pedido #{pedido_id} registrado com sucesso!")
+                            st.session_state.vendas = []
+                            st.session_state.total_vendas = 0.0
+                            st.rerun()
 
-                    except Exception as e:
-                        if conn: conn.rollback()
-                        st.error(f"Erro ao registrar pedido: {e}")
-                    finally:
-                        if cursor: cursor.close()
-                        if conn: conn.close()
+                        except psycopg2.errors.UndefinedFunction:
+                            conn.rollback()
+                            st.error("Erro ao registrar pedido: a função create_pedido não existe no banco (migração '006_create_pedido' não aplicada).")
+
+                        except Exception as e:
+                            conn.rollback()
+                            st.error(f"Erro ao registrar pedido: {e}")
 
     st.markdown("---")
 
@@ -964,7 +1382,7 @@ elif choice == "Pedidos de Venda":
         WHERE P.status_pedido = 'Pendente'
         ORDER BY P.data_pedido
     """
-    df_pendentes = pd.DataFrame(execute_query(sql_pendentes, fetch=True))
+    df_pendentes = fetch_query(sql_pendentes, tables=("Pedidos", "Clientes"))
 
     if df_pendentes.empty:
         st.info("Nenhum pedido pendente.")
@@ -983,27 +1401,30 @@ elif choice == "Pedidos de Venda":
         with col1:
             if st.button("✔️ Marcar como CONCLUÍDO", type="primary"):
                 if pedidos_selecionados:
-                    placeholders = ','.join(['%s'] * len(pedidos_selecionados))
-                    execute_query(
-                        f"UPDATE Pedidos SET status_pedido='Concluído' WHERE pedido_id IN ({placeholders})",
-                        pedidos_selecionados
-                    )
                     if imprimir_cupom:
+                        # UPDATE do status e detalhes de todos os cupons numa só ida ao banco.
+                        # Sem st.rerun(): os cupons (e eventuais erros) ficam na tela para impressão;
+                        # a versão de Pedidos já foi incrementada, a lista se atualiza na próxima interação
+                        detalhes_cupons = conclude_orders_with_coupon(pedidos_selecionados)
                         for pid in pedidos_selecionados:
-                            detalhes = get_order_details_for_coupon(pid)
-                            st.markdown(generate_non_fiscal_coupon(pid, detalhes), unsafe_allow_html=True)
-                    get_db_connection_cached.clear()
-                    st.rerun()
+                            if pid in detalhes_cupons:
+                                st.markdown(generate_non_fiscal_coupon(pid, detalhes_cupons[pid]), unsafe_allow_html=True)
+                    else:
+                        execute_query(
+                            "EXECUTE upd_status_pedidos (%s, %s)",
+                            ('Concluído', pedidos_selecionados),
+                            tables=("Pedidos",)
+                        )
+                        st.rerun()
 
         with col2:
             if st.button("❌ Marcar como CANCELADO"):
                 if pedidos_selecionados:
-                    placeholders = ','.join(['%s'] * len(pedidos_selecionados))
                     execute_query(
-                        f"UPDATE Pedidos SET status_pedido='Cancelado' WHERE pedido_id IN ({placeholders})",
-                        pedidos_selecionados
+                        "EXECUTE upd_status_pedidos (%s, %s)",
+                        ('Cancelado', pedidos_selecionados),
+                        tables=("Pedidos",)
                     )
-                    get_db_connection_cached.clear()
                     st.rerun()
 
 #-------------------------------------------------------------------------------------------------------------------------------------------
@@ -1020,46 +1441,67 @@ elif choice == "Devoluções":
         WHERE P.status_pedido = 'Concluído'
         ORDER BY P.data_pedido DESC
     """
-    df_pedidos_concluidos = pd.DataFrame(execute_query(sql_pedidos, fetch=True))
+    df_pedidos_concluidos = fetch_query(sql_pedidos, tables=("Pedidos", "Clientes"))
 
     if df_pedidos_concluidos.empty:
         st.info("Nenhum pedido concluído encontrado para realizar devoluções.")
     else:
         # 1. Seleção do Pedido
-        pedido_opcoes = {f"Pedido #{row['pedido_id']} - {row['cliente_nome']}": row['pedido_id'] 
-                         for _, row in df_pedidos_concluidos.iterrows()}
+        pedido_opcoes = {f"Pedido #{pid} - {nome}": int(pid)
+                         for pid, nome in zip(df_pedidos_concluidos['pedido_id'], df_pedidos_concluidos['cliente_nome'])}
         
         selecao_pedido = st.selectbox("Selecione o Pedido da Devolução", list(pedido_opcoes.keys()), index=None)
 
         if selecao_pedido:
             pedido_id_sel = pedido_opcoes[selecao_pedido]
             
-            # Busca itens daquele pedido
+            # Busca itens daquele pedido, um por produto (linhas repetidas somadas no Postgres),
+            # com a quantidade ainda devolvível (vendida menos o que já consta em Devolucoes)
             sql_itens = """
-                SELECT V.produto_id, Pr.descricao, V.quantidade, V.preco_unitario
+                SELECT V.produto_id, Pr.descricao,
+                       SUM(V.quantidade) - COALESCE(MAX(D.qtd_devolvida), 0) AS quantidade
                 FROM Vendas V
                 JOIN Produtos Pr ON V.produto_id = Pr.produto_id
-                WHERE V.pedido_id = %s
+                LEFT JOIN (
+                    SELECT produto_id, SUM(quantidade) AS qtd_devolvida
+                    FROM Devolucoes
+                    WHERE pedido_id = %(pedido_id)s
+                    GROUP BY produto_id
+                ) D ON D.produto_id = V.produto_id
+                WHERE V.pedido_id = %(pedido_id)s
+                GROUP BY V.produto_id, Pr.descricao
+                HAVING SUM(V.quantidade) - COALESCE(MAX(D.qtd_devolvida), 0) > 0
+                ORDER BY Pr.descricao
             """
-            df_itens_pedido = pd.DataFrame(execute_query(sql_itens, params=(pedido_id_sel,), fetch=True))
+            df_itens_pedido = fetch_query(
+                sql_itens, params={'pedido_id': int(pedido_id_sel)}, tables=("Vendas", "Produtos", "Devolucoes")
+            )
+
+            if df_itens_pedido.empty:
+                st.info("Nenhum item disponível para devolução neste pedido.")
+                st.stop()
 
             with st.form("form_devolucao"):
                 st.subheader("Detalhes da Devolução")
                 
                 col_dev1, col_dev2, col_dev3 = st.columns(3)
                 
-                # Seleção do Produto do Pedido
-                produto_para_devolver = col_dev1.selectbox(
+                # Itens do pedido por produto_id: descrição para exibir e quantidade ainda devolvível
+                produto_ids = df_itens_pedido['produto_id'].tolist()
+                id2desc = dict(zip(produto_ids, df_itens_pedido['descricao']))
+                id2qtd = dict(zip(produto_ids, df_itens_pedido['quantidade'].astype(int).tolist()))
+
+                # Seleção do Produto do Pedido (valor = produto_id)
+                produto_id_devolver = col_dev1.selectbox(
                     "Produto a ser devolvido", 
-                    df_itens_pedido['descricao'].tolist()
+                    list(id2desc),
+                    format_func=id2desc.get
                 )
                 
-                item_selecionado = df_itens_pedido[df_itens_pedido['descricao'] == produto_para_devolver].iloc[0]
-                
                 qtd_devolver = col_dev2.number_input(
                     "Quantidade", 
                     min_value=1, 
-                    max_value=int(item_selecionado['quantidade']),
+                    max_value=id2qtd[produto_id_devolver],
                     step=1
                 )
 
@@ -1086,63 +1528,51 @@ elif choice == "Devoluções":
                 submitted_dev = st.form_submit_button("Confirmar Devolução", type="primary")
 
                 if submitted_dev:
-                    try:
-                        conn = get_db_connection_new()
-                        cursor = conn.cursor()
-
-                        # 1. MAPEAMENTO DO ESTADO
-                        mapa_estado = {
-                            "Novo / Perfeito Estado": "Novo",
-                            "Avariado (Leve)": "Avariado",
-                            "Sucata / Danificado": "Sucata"
-                        }
-                        
-                        estado_final = mapa_estado[estado_produto]
-
-                        # 2. INSERE NA TABELA DE DEVOLUÇÕES (Incluindo data_devolucao)
-                        sql_insert_dev = """
-                            INSERT INTO Devolucoes 
-                            (pedido_id, produto_id, quantidade, estado_produto, retornou_estoque, motivo, data_devolucao)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s)
-                        """
-                        
-                        params_dev = (
-                            int(pedido_id_sel), 
-                            int(item_selecionado['produto_id']), 
-                            int(qtd_devolver), 
-                            estado_final, 
-                            bool(retornar_estoque), 
-                            motivo,
-                            data_devolucao_input # Passando a data selecionada
-                        )
-                        cursor.execute(sql_insert_dev, params_dev)
-
-                        # 3. ATUALIZA O ESTOQUE SE NECESSÁRIO
-                        if retornar_estoque:
-                            sql_update_estoque = "UPDATE Produtos SET estoque_atual = estoque_atual + %s WHERE produto_id = %s"
-                            cursor.execute(sql_update_estoque, (int(qtd_devolver), int(item_selecionado['produto_id'])))
-                            msg_estoque = "✅ Estoque atualizado."
-                        else:
-                            msg_estoque = "⚠️ Item registrado mas NÃO retornou ao estoque."
-
-                        conn.commit()
-                        st.success(f"Devolução registrada com sucesso para o dia {data_devolucao_input.strftime('%d/%m/%Y')}! {msg_estoque}")
-                        
-                        get_db_connection_cached.clear()
+                    with get_conn() as conn, conn.cursor() as cursor:
+                        try:
+                            # 1. MAPEAMENTO DO ESTADO
+                            mapa_estado = {
+                                "Novo / Perfeito Estado": "Novo",
+                                "Avariado (Leve)": "Avariado",
+                                "Sucata / Danificado": "Sucata"
+                            }
+                            
+                            estado_final = mapa_estado[estado_produto]
 
-                    except Exception as e:
-                        if conn: conn.rollback()
-                        st.error(f"Erro ao processar: {e}")
-                    finally:
-                        if cursor: cursor.close()
-                        if conn: conn.close()
+                            # 2. INSERE NA TABELA DE DEVOLUÇÕES E, SE APTO, DEVOLVE AO ESTOQUE (um único comando)
+                            sql_devolucao = "EXECUTE registrar_devolucao (%s, %s, %s, %s, %s, %s, %s)"
+                            
+                            params_dev = (
+                                int(pedido_id_sel), 
+                                int(produto_id_devolver), 
+                                int(qtd_devolver), 
+                                estado_final, 
+                                bool(retornar_estoque), 
+                                motivo,
+                                data_devolucao_input # Passando a data selecionada
+                            )
+                            cursor.execute(sql_devolucao, params_dev)
+
+                            # 3. MENSAGEM CONFORME O DESTINO DO ITEM
+                            if retornar_estoque:
+                                msg_estoque = "✅ Estoque atualizado."
+                            else:
+                                msg_estoque = "⚠️ Item registrado mas NÃO retornou ao estoque."
+
+                            conn.commit()
+                            invalidate_data_cache("Devolucoes", "Produtos")
+                            st.success(f"Devolução registrada com sucesso para o dia {data_devolucao_input.strftime('%d/%m/%Y')}! {msg_estoque}")
+
+                        except Exception as e:
+                            conn.rollback()
+                            st.error(f"Erro ao processar: {e}")
 
 #-------------------------------------------------------------------------------------------------------------------------------------------
 
 # --- NOVO MÓDULO: DESPESAS E FLUXO DE CAIXA ---
 elif choice == "Despesas e Fluxo de Caixa":
     st.header("💸 Despesas e Fluxo de Caixa (Contas a Pagar)")
-    
+
     with st.expander("➕ Registrar Nova Despesa/Pagamento"):
         with st.form("form_despesa"):
             st.subheader("Dados da Despesa")
@@ -1194,9 +1624,8 @@ elif choice == "Despesas e Fluxo de Caixa":
                         VALUES (%s, %s, %s, %s, %s, %s)
                     """
                     params = (tipo, descricao, float(valor), data_vencimento, status, data_pagamento)
-                    if execute_query(sql, params):
+                    if execute_query(sql, params, tables=("Despesas",)):
                         st.success(f"Despesa '{tipo} - {descricao}' registrada com sucesso!")
-                        get_db_connection_cached.clear()
                         st.rerun()
                     else:
                         st.error("Falha ao registrar despesa.")
@@ -1204,25 +1633,32 @@ elif choice == "Despesas e Fluxo de Caixa":
                     st.error("Preencha Tipo, Status e informe um valor maior que zero.")
 
     st.markdown("---")
-    
+
     st.subheader("Histórico e Controle de Despesas")
 
     df_despesas = fetch_all("Despesas")
-    
+
     if not df_despesas.empty:
         # Formatação de datas (Postgres/Supabase retorna date/datetime normalmente compatível)
-        df_despesas['data_vencimento'] = pd.to_datetime(df_despesas['data_vencimento']).dt.strftime('%d/%m/%Y')
-        df_despesas['data_pagamento'] = df_despesas['data_pagamento'].apply(
-            lambda x: pd.to_datetime(x).strftime('%d/%m/%Y') if pd.notna(x) and x != '' else '-'
+        # Colunas ficam nativas (datetime/float); a formatação é feita pelo front-end via column_config
+        for col_data in ('data_vencimento', 'data_pagamento'):
+            df_despesas[col_data] = pd.to_datetime(df_despesas[col_data], errors='coerce')
+        df_despesas['valor'] = pd.to_numeric(df_despesas['valor'], errors='coerce')
+
+        st.dataframe(
+            df_despesas.rename(columns={
+                'tipo_despesa': 'Tipo',
+                'descricao': 'Descrição',
+                'valor': 'Valor (R$)',
+                'data_vencimento': 'Vencimento',
+                'status': 'Status',
+                'data_pagamento': 'Data Pagamento'
+            }),
+            column_config={
+                'Vencimento': st.column_config.DateColumn(format="DD/MM/YYYY"),
+                'Data Pagamento': st.column_config.DateColumn(format="DD/MM/YYYY"),
+                'Valor (R$)': st.column_config.NumberColumn(format="R$ %.2f")
+            }
         )
-
-        st.dataframe(df_despesas.rename(columns={
-            'tipo_despesa': 'Tipo',
-            'descricao': 'Descrição',
-            'valor': 'Valor (R$)',
-            'data_vencimento': 'Vencimento',
-            'status': 'Status',
-            'data_pagamento': 'Data Pagamento'
-        }))
     else:
         st.info("Nenhuma despesa registrada ainda.")